@@ -1,27 +1,49 @@
 import os
 import re
+import queue
+import sys
 import json
 import time
+import argparse
+import asyncio
+import hashlib
+import itertools
 import logging
+import logging.handlers
+import sqlite3
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import shutil
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.util.retry import Retry
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
 
-import eyed3
 import mutagen
 from mutagen.oggopus import OggOpus
-from mutagen.id3 import ID3NoHeaderError
+from mutagen.id3 import ID3, ID3NoHeaderError, TIT2, TPE1, TALB, TDRC, TCOM, TCON, COMM
 from tqdm import tqdm
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("metadata_updater.log"),
-        logging.StreamHandler()
-    ]
-)
+# Configure logging. Records are written to the console and log file by a
+# background thread, so the processing loop never waits on the disk.
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+file_handler = logging.FileHandler("metadata_updater.log")
+stream_handler = logging.StreamHandler()
+for handler in (file_handler, stream_handler):
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+log_queue = queue.Queue(-1)
+log_listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+logging.root.setLevel(logging.INFO)
+logging.root.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener.start()
 logger = logging.getLogger(__name__)
 
 # Hardcoded configuration
@@ -30,23 +52,315 @@ OUTPUT_FOLDER = "output"
 OLLAMA_BASE_URL = "http://localhost:11434"  # Default Ollama URL
 OLLAMA_MODEL = "llama3.2"  # Change this to your preferred Ollama model
 BATCH_SIZE = 10
-RATE_LIMIT_DELAY = 1.0
+CONCURRENCY = 4  # Number of Ollama requests kept in flight at once
+IO_WORKERS = 8  # Threads copying and tagging files alongside the Ollama requests
+SCAN_WORKERS = 16  # Threads listing input subdirectories in parallel (or pass --workers)
+MAX_REQUESTS_PER_MINUTE = 300
+MAX_TOKENS_PER_MINUTE = 200000
+MAX_TOKENS_PER_SONG = 256  # Generation cap per song, in case the model never closes its JSON
+CACHE_FILE = "cache.db"  # Ollama responses are reused from here on later runs
+STATE_FILE = "state.json"  # Records finished files so later runs can skip them
 OVERWRITE = True
 INTERACTIVE_MODE = True  # Set to False to skip confirmation prompts
+FORCE = False  # Set to True (or pass --force) to reprocess files finished in an earlier run
+
+AUDIO_EXTENSIONS = (".mp3", ".opus")
+FICLONE = 0x40049409  # Linux ioctl that clones a file as a copy-on-write reflink
+COPY_CHUNK_SIZE = 64 * 1024 * 1024  # Bytes handed to each copy_file_range call
+
+# Patterns used by clean_filename
+_RE_LEAD_NUM = re.compile(r'^\d+[\s_\-\.]+')
+_RE_LEAD_BRACKET = re.compile(r'^\[.*?\][\s_\-\.]*')
+_RE_SEP = re.compile(r'[\s_\.]+')
+
+# Sent as the system message of every request. It must stay byte-identical across
+# calls so the server can reuse its cached prefix.
+_SYSTEM_MSG = """You identify songs from their filenames and provide their metadata as JSON.
+
+IMPORTANT RULES:
+1. For the title field, provide ONLY the song title without artist names
+2. Do NOT include artist names in the title - keep them separate in the artists field
+3. If the filename contains "Artist - Song Title", extract just "Song Title" for the title field
+
+Please provide the following information in JSON format:
+- title: The song title ONLY (no artist names)
+- artists: The performers/singers of the song (as a comma-separated string)
+- album: The album name or compilation it's from
+- year: The release year (as a number)
+- composer: The composer/producer/music director
+- genre: The primary genre of the song
+- language: The language of the song's lyrics
+
+If uncertain about any field, provide your best guess. If you cannot determine a field, use null."""
+
+# The single-song prompt is assembled from these pieces around the song name
+# and any existing metadata
+_PROMPT_HEAD = 'I need detailed metadata for the song with filename "'
+_PROMPT_MID = """".
+
+Return ONLY a JSON object with these fields.
+
+Example format:
+{"title": "Yesterday", "artists": "The Beatles", "album": "Help!", "year": 1965, "composer": "John Lennon, Paul McCartney", "genre": "Rock", "language": "English"}
+
+Filename to analyze: \""""
+_PROMPT_EXISTING_HEAD = '\n\nExisting metadata in the file:\n'
+_PROMPT_EXISTING_TAIL = "\nPlease use this existing information when it's correct, and only suggest changes when you can provide better/more accurate information."
+
+_BATCH_PROMPT_TEMPLATE = """I need detailed metadata for each of the {count} songs listed below by filename.
+
+Where existing metadata is given, use it when it's correct, and only suggest changes when you can provide better/more accurate information.
+
+Example format:
+{{"results": [{{"title": "Yesterday", "artists": "The Beatles", "album": "Help!", "year": 1965, "composer": "John Lennon, Paul McCartney", "genre": "Rock", "language": "English"}}]}}
+
+Filenames to analyze (return a JSON object {{"results":[...]}} with one entry per input, in order):
+{song_list}"""
+
+
+# Structured output schemas passed as Ollama's `format`, so generation is constrained
+# to exactly the object we parse (needs Ollama 0.5 or newer)
+_METADATA_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "title": {"type": ["string", "null"]},
+        "artists": {"type": ["string", "null"]},
+        "album": {"type": ["string", "null"]},
+        "year": {"type": ["integer", "null"]},
+        "composer": {"type": ["string", "null"]},
+        "genre": {"type": ["string", "null"]},
+        "language": {"type": ["string", "null"]}
+    },
+    "required": ["title", "artists", "album", "year", "composer", "genre", "language"]
+}
+
+_BATCH_SCHEMA = {
+    "type": "object",
+    "properties": {"results": {"type": "array", "items": _METADATA_SCHEMA}},
+    "required": ["results"]
+}
+
+
+class RateLimiter:
+    """
+    Token bucket that only releases a request when both the request and token budgets allow it.
+
+    Capacity refills continuously at the current request rate and at
+    `max_tokens_per_minute / 60` tokens per second. The request rate adapts to the
+    server: it starts at `max_requests_per_minute`, is halved whenever the server rate
+    limits us or times out, down to a tenth of the maximum, and grows back by a
+    twentieth of the maximum with every successful response.
+
+    `acquire` runs on the event loop, while responses are reported from worker threads;
+    the rate itself is only ever changed on the loop.
+    """
+
+    def __init__(self, max_requests_per_minute, max_tokens_per_minute):
+        self.max_requests_per_minute = max_requests_per_minute
+        self.min_requests_per_minute = max(max_requests_per_minute / 10, 1)
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.requests_per_minute = max_requests_per_minute
+        self.available_request_capacity = max_requests_per_minute
+        self.available_token_capacity = max_tokens_per_minute
+        self.last_update_time = time.monotonic()
+        self.loop = None
+
+    def _refill(self):
+        """Add the capacity earned since the last update."""
+        now = time.monotonic()
+        elapsed = now - self.last_update_time
+        self.last_update_time = now
+
+        self.available_request_capacity = min(
+            self.available_request_capacity + self.requests_per_minute * elapsed / 60,
+            self.requests_per_minute
+        )
+        self.available_token_capacity = min(
+            self.available_token_capacity + self.max_tokens_per_minute * elapsed / 60,
+            self.max_tokens_per_minute
+        )
+
+    async def acquire(self, tokens=1):
+        """Wait until there is capacity for one request of `tokens` tokens, then consume it."""
+        self.loop = asyncio.get_running_loop()
+        tokens = min(tokens, self.max_tokens_per_minute)
+        while True:
+            self._refill()
+            if self.available_request_capacity >= 1 and self.available_token_capacity >= tokens:
+                self.available_request_capacity -= 1
+                self.available_token_capacity -= tokens
+                return
+            await asyncio.sleep(0.01)
+
+    def _increase(self):
+        self.requests_per_minute = min(
+            self.requests_per_minute + self.max_requests_per_minute / 20,
+            self.max_requests_per_minute
+        )
+
+    def _decrease(self, reason):
+        self.requests_per_minute = max(self.requests_per_minute / 2, self.min_requests_per_minute)
+        logger.warning(f"{reason}, request rate is now {self.requests_per_minute:.0f}/min")
+
+    def record_success(self):
+        """Speed back up after a request was answered. Safe to call from any thread."""
+        self.loop.call_soon_threadsafe(self._increase)
+
+    def backoff(self, reason="Rate limited by server"):
+        """Halve the request rate after being rate limited or timing out. Safe to call from any thread."""
+        self.loop.call_soon_threadsafe(self._decrease, reason)
+
+
+class JsonObjectScanner:
+    """
+    Tracks brace depth over streamed text to detect when the first JSON object is complete.
+
+    Braces inside string literals are ignored. After `feed` returns True, `start` and `end`
+    delimit the object within all the text fed so far.
+    """
 
-class AudioMetadataGenerator:
     def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.position = 0
+        self.start = None
+        self.end = None
+
+    def feed(self, text):
+        """Scan more text, returning True once the object has closed."""
+        for offset, char in enumerate(text, self.position):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"' and self.start is not None:
+                self.in_string = True
+            elif char == "{":
+                if self.start is None:
+                    self.start = offset
+                self.depth += 1
+            elif char == "}" and self.depth:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.end = offset + 1
+                    return True
+        self.position += len(text)
+        return False
+
+
+def _is_timeout(error):
+    """
+    Check whether a requests exception means the server took too long to answer.
+    
+    Read timeouts while streaming a response body surface as a ConnectionError
+    wrapping urllib3's ReadTimeoutError rather than as a requests Timeout.
+    """
+    if isinstance(error, requests.exceptions.Timeout):
+        return True
+    return bool(error.args) and isinstance(error.args[0], ReadTimeoutError)
+
+
+def _keep_padding(info):
+    """
+    ID3 padding policy: reuse the existing padding when the new tag fits in it, otherwise
+    leave 1KB of room so later edits can be written in place.
+    """
+    return info.padding if info.padding >= 0 else 1024
+
+
+class MetadataCache:
+    """Persistent cache of Ollama metadata responses, keyed on the model, song and existing tags."""
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(str(path))
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, song TEXT, json TEXT, ts INTEGER)"
+        )
+        # Caches written by older versions have no timestamp column yet
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(entries)")]
+        if "ts" not in columns:
+            self.connection.execute("ALTER TABLE entries ADD COLUMN ts INTEGER")
+        self.connection.commit()
+
+    @staticmethod
+    def make_key(model, song_name, existing_metadata):
+        """
+        Hash the model, song name and existing metadata into a cache key.
+        
+        The prompt does not need to be built to look a song up.
+        """
+        payload = json.dumps({"m": model, "s": song_name, "e": existing_metadata}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key):
+        """Return the cached metadata for `key`, or None on a miss."""
+        row = self.connection.execute("SELECT json FROM entries WHERE key = ?", (key,)).fetchone()
+        return orjson.loads(row[0]) if row else None
+
+    def put(self, key, song_name, metadata):
+        """Store metadata for `key`."""
+        self.connection.execute(
+            "INSERT OR REPLACE INTO entries (key, song, json, ts) VALUES (?, ?, ?, ?)",
+            (key, song_name, json.dumps(metadata), int(time.time()))
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+class AudioMetadataGenerator:
+    def __init__(self, force=FORCE, scan_workers=SCAN_WORKERS):
         """
         Initialize the Audio metadata generator with hardcoded values for Ollama.
+        
+        With `force`, files recorded as finished in the state file are processed again.
+        `scan_workers` sets how many threads list the input folder.
         """
         self.input_folder = Path(INPUT_FOLDER)
         self.output_folder = Path(OUTPUT_FOLDER)
         self.ollama_base_url = OLLAMA_BASE_URL
         self.model = OLLAMA_MODEL
         self.batch_size = BATCH_SIZE
-        self.rate_limit_delay = RATE_LIMIT_DELAY
+        self.concurrency = CONCURRENCY
+        # Reuse keep-alive connections to Ollama, one per request in flight, and retry
+        # dropped connections and transient server errors. Generation has no side
+        # effects, so POSTs are retried too. Read timeouts are not retried: the server
+        # is already struggling, and another full generation would only add to that.
+        self.session = requests.Session()
+        self.session.headers["Connection"] = "keep-alive"
+        retry = Retry(
+            total=3,
+            read=False,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET", "POST"],
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # Blocking Ollama calls get their own threads so they never queue behind
+        # tagging work or the default executor's size limit
+        self.http_pool = ThreadPoolExecutor(max_workers=self.concurrency)
+        self.rate_limiter = RateLimiter(MAX_REQUESTS_PER_MINUTE, MAX_TOKENS_PER_MINUTE)
+        self.cache = MetadataCache(CACHE_FILE)
+        self.io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS)
+        # Tag readers and writers by lowercase file extension
+        self.readers = {".mp3": self.get_mp3_existing_metadata, ".opus": self.get_opus_existing_metadata}
+        self.writers = {".mp3": self.update_mp3_metadata, ".opus": self.update_opus_metadata}
         self.overwrite = OVERWRITE
         self.interactive_mode = INTERACTIVE_MODE
+        self.force = force
+        self.scan_workers = scan_workers
+        self.state_file = Path(STATE_FILE)
+        self.state = self.load_state()
+        # Set when files are marked done, so the state file is only written when it changed
+        self.state_dirty = False
         
         # Ensure folders exist
         if not self.input_folder.exists():
@@ -70,13 +384,17 @@ class AudioMetadataGenerator:
             "processed_files": 0,
             "success": 0,
             "errors": 0,
-            "skipped": 0
+            "skipped": 0,
+            "cache_hits": 0
         }
+        # One lock per output path, see write_output
+        self.output_locks = {}
+        self.output_locks_guard = threading.Lock()
         
     def test_ollama_connection(self):
         """Test connection to Ollama server."""
         try:
-            response = requests.get(f"{self.ollama_base_url}/api/tags")
+            response = self.session.get(f"{self.ollama_base_url}/api/tags")
             response.raise_for_status()
             
             # Check if our model is available
@@ -90,21 +408,111 @@ class AudioMetadataGenerator:
         except requests.exceptions.RequestException as e:
             raise Exception(f"Cannot connect to Ollama at {self.ollama_base_url}. Make sure Ollama is running. Error: {e}")
     
-    def get_audio_files(self):
-        """Find all audio files (MP3 and Opus) in the input folder."""
+    def load_state(self):
+        """Load the record of files finished in earlier runs."""
+        if not self.state_file.exists():
+            return {}
         try:
-            mp3_files = list(self.input_folder.glob("**/*.mp3"))
-            opus_files = list(self.input_folder.glob("**/*.opus"))
-            all_files = mp3_files + opus_files
-            
-            logger.info(f"Found {len(mp3_files)} MP3 files and {len(opus_files)} Opus files in {self.input_folder}")
-            logger.info(f"Total audio files: {len(all_files)}")
-            
-            self.stats["total_files"] = len(all_files)
-            return all_files
+            with open(self.state_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable state file {self.state_file}: {e}")
+            return {}
+    
+    def save_state(self):
+        """Write the state file, replacing the old one only once the new one is on disk."""
+        if not self.state_dirty:
+            return
+        tmp_path = self.state_file.with_name(self.state_file.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.state_file)
+        self.state_dirty = False
+    
+    def _state_key(self, file_path):
+        return file_path.relative_to(self.input_folder).as_posix()
+    
+    def is_done(self, file_path):
+        """
+        Check whether a file was updated in an earlier run and has not changed since.
+        
+        Its output must also still be there, and at least as large as the source,
+        so cleared or truncated outputs are written again.
+        """
+        entry = self.state.get(self._state_key(file_path))
+        if not entry or not entry.get("done"):
+            return False
+        stat = file_path.stat()
+        if entry.get("src_mtime") != stat.st_mtime or entry.get("src_size") != stat.st_size:
+            return False
+        try:
+            return (self.output_folder / file_path.name).stat().st_size >= stat.st_size
+        except OSError:
+            return False
+    
+    def mark_done(self, file_path):
+        """Record a file as successfully updated."""
+        stat = file_path.stat()
+        self.state[self._state_key(file_path)] = {
+            "src_mtime": stat.st_mtime,
+            "src_size": stat.st_size,
+            "done": True
+        }
+        self.state_dirty = True
+    
+    def _scan_directory(self, directory):
+        """List one directory, returning its audio files and its subdirectories."""
+        audio_files, subdirectories = [], []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+                elif entry.name.lower().endswith(AUDIO_EXTENSIONS):
+                    audio_files.append(Path(entry.path))
+        return audio_files, subdirectories
+    
+    def _scan_tree(self, directory):
+        """Recursively find all audio files below a directory."""
+        audio_files = []
+        pending = [directory]
+        while pending:
+            current = pending.pop()
+            try:
+                found, subdirectories = self._scan_directory(current)
+            except OSError as e:
+                logger.warning(f"Cannot read directory {current}: {e}")
+                continue
+            audio_files.extend(found)
+            pending.extend(subdirectories)
+        return audio_files
+    
+    def iter_audio_files(self):
+        """
+        Yield the audio files (MP3 and Opus) in the input folder as they are found.
+        
+        The per-type counts are logged, and the total recorded, once the scan is complete.
+        """
+        counts = Counter()
+        try:
+            # Files at the top level come first; each subdirectory is scanned on its own
+            # worker thread, which helps a lot on high-latency network mounts, and its
+            # files are handed out as soon as that subtree has been listed
+            top_files, subdirectories = self._scan_directory(self.input_folder)
+            with ThreadPoolExecutor(max_workers=self.scan_workers) as pool:
+                futures = [pool.submit(self._scan_tree, directory) for directory in subdirectories]
+                for found in itertools.chain([top_files], (future.result() for future in as_completed(futures))):
+                    for file_path in found:
+                        counts[file_path.suffix.lower()] += 1
+                        yield file_path
         except Exception as e:
             logger.error(f"Error finding audio files: {e}")
-            return []
+        
+        total = sum(counts.values())
+        logger.info(f"Found {counts['.mp3']} MP3 files and {counts['.opus']} Opus files in {self.input_folder}")
+        logger.info(f"Total audio files: {total}")
+        self.stats["total_files"] = total
     
     def clean_filename(self, filename):
         """Extract and clean the song name from the filename."""
@@ -112,92 +520,124 @@ class AudioMetadataGenerator:
         name = os.path.splitext(filename)[0]
         
         # Remove common prefixes, numbering, etc.
-        name = re.sub(r'^\d+[\s_\-\.]+', '', name)  # Remove leading numbers with separators
-        name = re.sub(r'^\[.*?\][\s_\-\.]*', '', name)  # Remove bracketed text at start
+        # Both patterns are anchored, so skip them unless the first character could match
+        if name[:1].isdigit():
+            name = _RE_LEAD_NUM.sub('', name)  # Remove leading numbers with separators
+        if name.startswith('['):
+            name = _RE_LEAD_BRACKET.sub('', name)  # Remove bracketed text at start
         
         # Check if it's in "Artist - Title" format and preserve the structure for AI processing
         # Don't strip the artist part here - let the AI handle the separation
         
-        # Replace underscores and dots with spaces, but keep dashes for "Artist - Title" detection
-        name = re.sub(r'[_\.]+', ' ', name)
-        
-        # Remove extra spaces but keep single dashes
-        name = re.sub(r'\s+', ' ', name).strip()
+        # Turn runs of underscores, dots and whitespace into single spaces,
+        # but keep dashes for "Artist - Title" detection
+        name = _RE_SEP.sub(' ', name).strip()
         
         return name
     
-    def get_metadata_from_ollama(self, song_name, existing_metadata=None):
-        """Query Ollama to get metadata for a song."""
+    def _is_complete(self, existing_metadata):
+        """Check whether a file already has all of the main metadata fields."""
+        return all(existing_metadata.get(field) for field in ("title", "artist", "album", "year", "genre"))
+    
+    def _non_empty_fields(self, existing_metadata):
+        """Return only the existing metadata fields that carry a value."""
+        if not existing_metadata:
+            return {}
+        return {k: v for k, v in existing_metadata.items() if v and v != "(empty)"}
+    
+    def build_prompt(self, song_name, existing_metadata=None):
+        """Build the Ollama prompt for a song, including any existing metadata as context."""
+        parts = [_PROMPT_HEAD, song_name, _PROMPT_MID, song_name, '"']
+        
+        # Add context about existing metadata
+        non_empty_fields = self._non_empty_fields(existing_metadata)
+        if non_empty_fields:
+            parts += [_PROMPT_EXISTING_HEAD, orjson.dumps(non_empty_fields, option=orjson.OPT_INDENT_2).decode(), _PROMPT_EXISTING_TAIL]
         
-        # Create context about existing metadata
-        existing_context = ""
-        if existing_metadata:
-            non_empty_fields = {k: v for k, v in existing_metadata.items() if v and v != "(empty)"}
+        return "".join(parts)
+    
+    def build_batch_prompt(self, songs):
+        """Build one Ollama prompt asking for metadata of several (song_name, existing_metadata) pairs."""
+        lines = []
+        for number, (song_name, existing_metadata) in enumerate(songs, 1):
+            lines.append(f'{number}. "{song_name}"')
+            non_empty_fields = self._non_empty_fields(existing_metadata)
             if non_empty_fields:
-                existing_context = f"\n\nExisting metadata in the file:\n{json.dumps(non_empty_fields, indent=2)}\nPlease use this existing information when it's correct, and only suggest changes when you can provide better/more accurate information."
+                lines.append(f"   Existing metadata in the file: {orjson.dumps(non_empty_fields).decode()}")
+        song_list = "\n".join(lines)
         
-        prompt = f"""I need detailed metadata for the song with filename "{song_name}". 
-
-IMPORTANT RULES:
-1. For the title field, provide ONLY the song title without artist names
-2. Do NOT include artist names in the title - keep them separate in the artists field
-3. If the filename contains "Artist - Song Title", extract just "Song Title" for the title field
-
-Please provide the following information in JSON format:
-- title: The song title ONLY (no artist names)
-- artists: The performers/singers of the song (as a comma-separated string)
-- album: The album name or compilation it's from
-- year: The release year (as a number)
-- composer: The composer/producer/music director
-- genre: The primary genre of the song
-- language: The language of the song's lyrics
-
-Return ONLY a JSON object with these fields. If uncertain about any field, provide your best guess. If you cannot determine a field, use null.
-
-Example format:
-{{"title": "Yesterday", "artists": "The Beatles", "album": "Help!", "year": 1965, "composer": "John Lennon, Paul McCartney", "genre": "Rock", "language": "English"}}
-
-Filename to analyze: "{song_name}"{existing_context}"""
+        return _BATCH_PROMPT_TEMPLATE.format(count=len(songs), song_list=song_list)
+    
+    def _generate(self, prompt, schema, max_tokens=MAX_TOKENS_PER_SONG):
+        """
+        Stream a completion for the prompt from Ollama and return the generated JSON text.
         
+        The output is constrained to the JSON `schema`, and generated text after the
+        first complete JSON object is ignored. The rest of the stream is still read to
+        the end, which is bounded by `max_tokens`, so that the connection goes back to
+        the session's pool for the next request.
+        """
         try:
-            response = requests.post(
+            response = self.session.post(
                 f"{self.ollama_base_url}/api/generate",
                 json={
                     "model": self.model,
+                    "system": _SYSTEM_MSG,
                     "prompt": prompt,
-                    "stream": False,
-                    "format": "json"
+                    "stream": True,
+                    "format": schema,
+                    "options": {"num_predict": max_tokens}
                 },
+                stream=True,
                 timeout=30
             )
-            
             response.raise_for_status()
-            result = response.json()
-            
-            if "response" not in result:
-                logger.error(f"Unexpected response format from Ollama: {result}")
-                return {"title": song_name, "error": "Invalid response format"}
+        except requests.exceptions.RequestException as e:
+            if e.response is not None and e.response.status_code == 429:
+                self.rate_limiter.backoff()
+            elif _is_timeout(e):
+                self.rate_limiter.backoff("Request to server timed out")
+            raise
+        
+        scanner = JsonObjectScanner()
+        parts = []
+        try:
+            with response:
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    chunk = orjson.loads(line)
+                    if "response" not in chunk:
+                        logger.error(f"Unexpected response format from Ollama: {chunk}")
+                        raise ValueError(chunk.get("error", "Invalid response format"))
+                    
+                    if scanner.end is None:
+                        parts.append(chunk["response"])
+                        scanner.feed(chunk["response"])
+        except requests.exceptions.RequestException as e:
+            # The server stalled part way through the response
+            if _is_timeout(e):
+                self.rate_limiter.backoff("Request to server timed out")
+            raise
+        self.rate_limiter.record_success()
+        
+        text = "".join(parts)
+        return text[:scanner.end] if scanner.end is not None else text
+    
+    def get_metadata_from_ollama(self, song_name, prompt):
+        """Query Ollama with a prompt built by `build_prompt` to get metadata for a song."""
+        try:
+            response_text = self._generate(prompt, _METADATA_SCHEMA)
             
             # Parse the JSON response
             try:
-                metadata_text = result["response"].strip()
-                # Sometimes Ollama adds extra text, try to extract just the JSON
-                if metadata_text.startswith('{') and metadata_text.endswith('}'):
-                    metadata = json.loads(metadata_text)
-                else:
-                    # Try to find JSON in the response
-                    json_match = re.search(r'\{.*\}', metadata_text, re.DOTALL)
-                    if json_match:
-                        metadata = json.loads(json_match.group())
-                    else:
-                        raise json.JSONDecodeError("No JSON found", metadata_text, 0)
-                
+                metadata = orjson.loads(response_text)
                 logger.debug(f"Got metadata for '{song_name}': {metadata}")
                 return metadata
                 
             except json.JSONDecodeError as e:
                 logger.error(f"Failed to parse JSON from Ollama response: {e}")
-                logger.error(f"Raw response: {result.get('response', 'No response')}")
+                logger.error(f"Raw response: {response_text}")
                 return {"title": song_name, "error": "Failed to parse response"}
             
         except requests.exceptions.RequestException as e:
@@ -207,11 +647,35 @@ Filename to analyze: "{song_name}"{existing_context}"""
             logger.error(f"Error getting metadata for '{song_name}': {e}")
             return {"error": str(e), "title": song_name}
     
+    def get_metadata_batch(self, songs, prompt=None):
+        """
+        Query Ollama for the metadata of several (song_name, existing_metadata) pairs in one request.
+        
+        `prompt` is built with `build_batch_prompt` unless the caller already has it.
+        Returns one metadata dict per song, in input order, or None if the response
+        could not be used, in which case the songs should be looked up one at a time.
+        """
+        if prompt is None:
+            prompt = self.build_batch_prompt(songs)
+        try:
+            response_text = self._generate(prompt, _BATCH_SCHEMA, max_tokens=MAX_TOKENS_PER_SONG * len(songs))
+            results = orjson.loads(response_text).get("results")
+        except Exception as e:
+            logger.warning(f"Batch lookup of {len(songs)} songs failed: {e}")
+            return None
+        
+        if not isinstance(results, list) or len(results) != len(songs) or not all(isinstance(m, dict) for m in results):
+            logger.warning(f"Batch lookup returned an unexpected result for {len(songs)} songs, falling back to single lookups")
+            return None
+        
+        for (song_name, _), metadata in zip(songs, results):
+            logger.debug(f"Got metadata for '{song_name}': {metadata}")
+        return results
+    
     def display_metadata_comparison(self, filename, existing, new_metadata, file_type):
         """Display a comparison of existing vs new metadata."""
-        print("\n" + "="*80)
-        print(f"FILE: {filename} ({file_type})")
-        print("="*80)
+        # Build the whole report and write it at once
+        lines = ["", "="*80, f"FILE: {filename} ({file_type})", "="*80]
         
         # Map new metadata keys to display format
         field_mapping = {
@@ -232,22 +696,23 @@ Filename to analyze: "{song_name}"{existing_context}"""
             
             if old_val != new_val:
                 changes_found = True
-                print(f"{display_name:12} | OLD: {old_val}")
-                print(f"{' '*12} | NEW: {new_val}")
-                print("-" * 50)
+                lines.append(f"{display_name:12} | OLD: {old_val}")
+                lines.append(f"{' '*12} | NEW: {new_val}")
+                lines.append("-" * 50)
             else:
-                print(f"{display_name:12} | {old_val} (no change)")
+                lines.append(f"{display_name:12} | {old_val} (no change)")
         
         # Show comments for MP3 files
         if file_type == "MP3" and existing.get("comments"):
-            print(f"{'Comments':12} | {existing['comments']}")
+            lines.append(f"{'Comments':12} | {existing['comments']}")
         
         if not changes_found:
-            print("\nNO CHANGES DETECTED - All metadata matches existing values")
+            lines.append("\nNO CHANGES DETECTED - All metadata matches existing values")
         else:
-            print(f"\nCHANGES DETECTED for {filename}")
+            lines.append(f"\nCHANGES DETECTED for {filename}")
         
-        print("="*80)
+        lines.append("="*80)
+        sys.stdout.write("\n".join(lines) + "\n")
 
     def confirm_update(self):
         """Ask user for confirmation to proceed with the update."""
@@ -269,30 +734,87 @@ Filename to analyze: "{song_name}"{existing_context}"""
             else:
                 print("Please enter 'y' (yes), 'n' (no), 'a' (yes to all), or 'q' (quit)")
 
+    def copy_file(self, source_path, output_path):
+        """
+        Copy a file into the output folder.
+        
+        When both folders are on the same filesystem the copy is first attempted as a
+        reflink, which shares the audio data with the source until it is modified.
+        Otherwise the data is copied inside the kernel with copy_file_range where the
+        platform has it, which also lets NFS and SMB mounts copy on the server side.
+        Anything else falls back to a regular copy.
+        """
+        source_stat = os.stat(source_path)
+        output_dir = os.path.dirname(output_path) or "."
+        if fcntl is not None and source_stat.st_dev == os.stat(output_dir).st_dev:
+            try:
+                with open(source_path, "rb") as src, open(output_path, "wb") as dst:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                self._copy_times(source_stat, output_path)
+                return
+            except OSError as e:
+                logger.debug(f"Reflink copy not available for '{output_path}', copying instead: {e}")
+        
+        if hasattr(os, "copy_file_range"):
+            try:
+                with open(source_path, "rb") as src, open(output_path, "wb") as dst:
+                    while os.copy_file_range(src.fileno(), dst.fileno(), COPY_CHUNK_SIZE):
+                        pass
+                self._copy_times(source_stat, output_path)
+                return
+            except OSError as e:
+                logger.debug(f"copy_file_range not available for '{output_path}', copying instead: {e}")
+        
+        shutil.copyfile(source_path, output_path)
+        self._copy_times(source_stat, output_path)
+
+    def _copy_times(self, source_stat, output_path):
+        """
+        Give the copy the source's access and modification times.
+        
+        This is all of copystat that matters for the output, without its extra
+        stat, chmod and extended-attribute calls per file.
+        """
+        os.utime(output_path, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+
     def get_mp3_existing_metadata(self, file_path):
         """Extract existing metadata from MP3 file."""
         existing = {}
         try:
-            audiofile = eyed3.load(str(file_path))
-            if audiofile and audiofile.tag:
-                existing = {
-                    "title": audiofile.tag.title or "",
-                    "artist": audiofile.tag.artist or "",
-                    "album": audiofile.tag.album or "",
-                    "year": str(audiofile.tag.recording_date) if audiofile.tag.recording_date else "",
-                    "composer": audiofile.tag.composer or "",
-                    "genre": str(audiofile.tag.genre) if audiofile.tag.genre else "",
-                    "comments": [str(comment) for comment in audiofile.tag.comments] if audiofile.tag.comments else []
-                }
+            # Parse only the ID3 tag, without scanning the MPEG audio frames
+            tags = ID3(str(file_path))
+            existing = {
+                "title": str(tags["TIT2"]) if "TIT2" in tags else "",
+                "artist": str(tags["TPE1"]) if "TPE1" in tags else "",
+                "album": str(tags["TALB"]) if "TALB" in tags else "",
+                # ID3v2.3 year frames are read as TDRC too
+                "year": str(tags["TDRC"]) if "TDRC" in tags else "",
+                "composer": str(tags["TCOM"]) if "TCOM" in tags else "",
+                "genre": ", ".join(tags["TCON"].genres) if "TCON" in tags else "",
+                "comments": [str(comment) for comment in tags.getall("COMM")]
+            }
+        except ID3NoHeaderError:
+            pass
         except Exception as e:
             logger.warning(f"Error reading existing MP3 metadata: {e}")
         return existing
 
-    def update_mp3_metadata(self, file_path, metadata):
-        """Update the ID3 tags of an MP3 file with the provided metadata."""
+    def update_mp3_metadata(self, file_path, metadata, existing_metadata=None):
+        """
+        Update the ID3 tags of an MP3 file with the provided metadata.
+        
+        `existing_metadata` is read from the file unless the caller already has it.
+        Returns "success", "skipped" or "error".
+        """
         try:
             # First, get existing metadata
-            existing_metadata = self.get_mp3_existing_metadata(file_path)
+            if existing_metadata is None:
+                existing_metadata = self.get_mp3_existing_metadata(file_path)
+            
+            # Check if we should overwrite existing metadata, before copying anything
+            if not self.overwrite and (existing_metadata.get("title") or existing_metadata.get("artist")):
+                logger.info(f"Skipping '{file_path.name}' - already has metadata and overwrite is False")
+                return "skipped"
             
             # Show comparison
             self.display_metadata_comparison(file_path.name, existing_metadata, metadata, "MP3")
@@ -300,70 +822,66 @@ Filename to analyze: "{song_name}"{existing_context}"""
             # Ask for confirmation
             if not self.confirm_update():
                 logger.info(f"Skipping '{file_path.name}' - user declined update")
-                self.stats["skipped"] += 1
-                return False
+                return "skipped"
             
-            output_path = str(self.output_folder / file_path.name)
-            source_path = str(file_path)
+            self.write_output(file_path, metadata, self._tag_mp3, "MP3")
+            return "success"
             
-            # Copy the file to the output directory
-            logger.info(f"Copying MP3 file to output folder: {output_path}")
-            shutil.copy2(source_path, output_path)
-            
-            # Load the MP3 file
-            audiofile = eyed3.load(output_path)
+        except Exception as e:
+            logger.error(f"Error updating MP3 metadata for '{file_path.name}': {str(e)}")
+            return "error"
+
+    def _tag_mp3(self, path, metadata):
+        """Write the metadata into the ID3 tag of the MP3 file at `path`, returning whether anything changed."""
+        # Load the ID3 tag
+        try:
+            tags = ID3(path)
+        except ID3NoHeaderError:
+            # Initialize ID3 tag if it doesn't exist
+            tags = ID3()
             
-            if audiofile is None:
-                logger.error(f"Failed to load MP3 file {output_path}")
-                return False
+        # Build the frames for our metadata
+        frames = []
+        if metadata.get("title"):
+            frames.append(TIT2(encoding=3, text=str(metadata["title"])))
             
-            # Initialize ID3 tag if it doesn't exist
-            if audiofile.tag is None:
-                audiofile.initTag(version=(2, 3, 0))
-            elif not self.overwrite and (audiofile.tag.title or audiofile.tag.artist):
-                logger.info(f"Skipping '{file_path.name}' - already has metadata and overwrite is False")
-                self.stats["skipped"] += 1
-                return False
-                
-            # Update the tags with our metadata
-            if metadata.get("title"):
-                audiofile.tag.title = str(metadata["title"])
-                
-            if metadata.get("artists"):
-                audiofile.tag.artist = str(metadata["artists"])
-                    
-            if metadata.get("album"):
-                audiofile.tag.album = str(metadata["album"])
-                
-            if metadata.get("year"):
-                try:
-                    year_val = str(metadata["year"])
-                    if year_val.isdigit():
-                        audiofile.tag.recording_date = year_val
-                except (ValueError, TypeError) as e:
-                    logger.warning(f"Invalid year value '{metadata.get('year')}': {e}")
+        if metadata.get("artists"):
+            frames.append(TPE1(encoding=3, text=str(metadata["artists"])))
                 
-            if metadata.get("composer"):
-                audiofile.tag.composer = str(metadata["composer"])
-                
-            if metadata.get("language"):
-                audiofile.tag.comments.set(f"Language: {metadata['language']}")
-                
-            if metadata.get("genre"):
-                try:
-                    audiofile.tag.genre = str(metadata["genre"])
-                except Exception as e:
-                    logger.warning(f"Error setting genre '{metadata.get('genre')}': {e}")
-                    audiofile.tag.comments.set(f"Genre: {metadata['genre']}")
+        if metadata.get("album"):
+            frames.append(TALB(encoding=3, text=str(metadata["album"])))
             
-            # Save the changes
-            audiofile.tag.save(output_path)
-            logger.info(f"Successfully updated MP3 metadata for '{file_path.name}'")
-            return True
+        if metadata.get("year"):
+            year_val = str(metadata["year"])
+            if year_val.isdigit():
+                frames.append(TDRC(encoding=3, text=year_val))
+            else:
+                logger.debug(f"Invalid year value '{metadata.get('year')}'")
             
-        except Exception as e:
-            logger.error(f"Error updating MP3 metadata for '{file_path.name}': {str(e)}")
-            return False
+        if metadata.get("composer"):
+            frames.append(TCOM(encoding=3, text=str(metadata["composer"])))
+            
+        if metadata.get("language"):
+            frames.append(COMM(encoding=3, lang="eng", desc="", text=f"Language: {metadata['language']}"))
+            
+        if metadata.get("genre"):
+            frames.append(TCON(encoding=3, text=str(metadata["genre"])))
+        
+        # Only add the frames whose value actually differs
+        changed = False
+        for frame in frames:
+            current = tags.get(frame.HashKey)
+            if current is None or str(current) != str(frame):
+                tags.add(frame)
+                changed = True
+        
+        if changed:
+            # mutagen loads every tag as ID3v2.4, so convert the frames back (TDRC to TYER
+            # and so on) before saving as v2.3. Only the tag at the start of the file is
+            # rewritten, unless it outgrows its padding and the audio has to be moved.
+            tags.update_to_v23()
+            tags.save(path, v2_version=3, padding=_keep_padding)
+        return changed
 
     def get_opus_existing_metadata(self, file_path):
         """Extract existing metadata from Opus file."""
@@ -387,11 +905,22 @@ Filename to analyze: "{song_name}"{existing_context}"""
             logger.warning(f"Error reading existing Opus metadata: {e}")
         return existing
 
-    def update_opus_metadata(self, file_path, metadata):
-        """Update the metadata of an Opus file with the provided metadata."""
+    def update_opus_metadata(self, file_path, metadata, existing_metadata=None):
+        """
+        Update the metadata of an Opus file with the provided metadata.
+        
+        `existing_metadata` is read from the file unless the caller already has it.
+        Returns "success", "skipped" or "error".
+        """
         try:
             # First, get existing metadata
-            existing_metadata = self.get_opus_existing_metadata(file_path)
+            if existing_metadata is None:
+                existing_metadata = self.get_opus_existing_metadata(file_path)
+            
+            # Check if we should overwrite existing metadata, before copying anything
+            if not self.overwrite and (existing_metadata.get("title") or existing_metadata.get("artist")):
+                logger.info(f"Skipping '{file_path.name}' - already has metadata and overwrite is False")
+                return "skipped"
             
             # Show comparison
             self.display_metadata_comparison(file_path.name, existing_metadata, metadata, "Opus")
@@ -399,126 +928,319 @@ Filename to analyze: "{song_name}"{existing_context}"""
             # Ask for confirmation
             if not self.confirm_update():
                 logger.info(f"Skipping '{file_path.name}' - user declined update")
-                self.stats["skipped"] += 1
-                return False
-            
-            output_path = str(self.output_folder / file_path.name)
-            source_path = str(file_path)
+                return "skipped"
             
-            # Copy the file to the output directory
-            logger.info(f"Copying Opus file to output folder: {output_path}")
-            shutil.copy2(source_path, output_path)
+            self.write_output(file_path, metadata, self._tag_opus, "Opus")
+            return "success"
             
-            # Load the Opus file
-            try:
-                audiofile = OggOpus(output_path)
-            except Exception as e:
-                logger.error(f"Failed to load Opus file {output_path}: {e}")
-                return False
+        except Exception as e:
+            logger.error(f"Error updating Opus metadata for '{file_path.name}': {str(e)}")
+            return "error"
+
+    def _tag_opus(self, path, metadata):
+        """Write the metadata into the Opus file at `path`, returning whether anything changed."""
+        audiofile = OggOpus(path)
+        
+        # Collect the tags for our metadata
+        values = {}
+        if metadata.get("title"):
+            values["TITLE"] = str(metadata["title"])
             
-            # Check if we should overwrite existing metadata
-            if not self.overwrite and (audiofile.get("TITLE") or audiofile.get("ARTIST")):
-                logger.info(f"Skipping '{file_path.name}' - already has metadata and overwrite is False")
-                self.stats["skipped"] += 1
-                return False
-                
-            # Update the tags with our metadata
-            if metadata.get("title"):
-                audiofile["TITLE"] = str(metadata["title"])
-                
-            if metadata.get("artists"):
-                audiofile["ARTIST"] = str(metadata["artists"])
-                    
-            if metadata.get("album"):
-                audiofile["ALBUM"] = str(metadata["album"])
-                
-            if metadata.get("year"):
-                try:
-                    year_val = str(metadata["year"])
-                    if year_val.isdigit():
-                        audiofile["DATE"] = year_val
-                except (ValueError, TypeError) as e:
-                    logger.warning(f"Invalid year value '{metadata.get('year')}': {e}")
-                
-            if metadata.get("composer"):
-                audiofile["COMPOSER"] = str(metadata["composer"])
+        if metadata.get("artists"):
+            values["ARTIST"] = str(metadata["artists"])
                 
-            if metadata.get("language"):
-                audiofile["LANGUAGE"] = str(metadata["language"])
-                
-            if metadata.get("genre"):
-                audiofile["GENRE"] = str(metadata["genre"])
+        if metadata.get("album"):
+            values["ALBUM"] = str(metadata["album"])
             
-            # Save the changes
-            audiofile.save()
-            logger.info(f"Successfully updated Opus metadata for '{file_path.name}'")
-            return True
+        if metadata.get("year"):
+            year_val = str(metadata["year"])
+            if year_val.isdigit():
+                values["DATE"] = year_val
+            else:
+                logger.debug(f"Invalid year value '{metadata.get('year')}'")
             
-        except Exception as e:
-            logger.error(f"Error updating Opus metadata for '{file_path.name}': {str(e)}")
-            return False
+        if metadata.get("composer"):
+            values["COMPOSER"] = str(metadata["composer"])
+            
+        if metadata.get("language"):
+            values["LANGUAGE"] = str(metadata["language"])
+            
+        if metadata.get("genre"):
+            values["GENRE"] = str(metadata["genre"])
+        
+        # Only set the tags whose value actually differs
+        changed = False
+        for key, value in values.items():
+            if audiofile.get(key) != [value]:
+                audiofile[key] = value
+                changed = True
+        
+        if changed:
+            audiofile.save()
+        return changed
 
-    def update_audio_metadata(self, file_path, metadata):
-        """Update metadata for either MP3 or Opus files based on file extension."""
-        file_extension = file_path.suffix.lower()
+    def _output_lock(self, output_path):
+        """Return the lock that writes to `output_path` must hold."""
+        with self.output_locks_guard:
+            return self.output_locks.setdefault(os.path.normcase(output_path), threading.Lock())
+
+    def write_output(self, file_path, metadata, tag_file, file_type):
+        """
+        Copy a file into the output folder and tag the copy with `tag_file(path, metadata)`.
+        
+        The copy is tagged under a temporary name and only moved into place once it is
+        complete, so a failed write never leaves a broken file behind. The output folder
+        is flat and files in different subfolders can share a name, so writes to the same
+        output path take turns; the last one wins.
+        """
+        output_path = str(self.output_folder / file_path.name)
+        source_path = str(file_path)
+        tmp_path = str(self.output_folder / f".{file_path.name}.tmp")
+        
+        with self._output_lock(output_path):
+            try:
+                self.copy_file(source_path, tmp_path)
+                changed = tag_file(tmp_path, metadata)
+                os.replace(tmp_path, output_path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
         
-        if file_extension == ".mp3":
-            return self.update_mp3_metadata(file_path, metadata)
-        elif file_extension == ".opus":
-            return self.update_opus_metadata(file_path, metadata)
+        if changed:
+            logger.info(f"Tagged {file_type} {source_path} -> {output_path}")
         else:
-            logger.error(f"Unsupported file format: {file_extension}")
-            return False
+            logger.info(f"Copied {file_type} {source_path} -> {output_path} (tags already up to date)")
+
+    def get_existing_metadata(self, file_path, file_extension=None):
+        """Read the existing metadata of either an MP3 or Opus file."""
+        if file_extension is None:
+            file_extension = file_path.suffix.lower()
+        
+        reader = self.readers.get(file_extension)
+        if reader is None:
+            logger.warning(f"Cannot read metadata of unsupported file format: {file_extension or file_path.name}")
+            return {}
+        return reader(file_path)
+
+    def update_audio_metadata(self, file_path, metadata, existing_metadata=None, file_extension=None):
+        """
+        Update metadata for either MP3 or Opus files based on file extension.
+        
+        Callers that already have the lowercase extension can pass it as `file_extension`.
+        Returns "success", "skipped" or "error"; the caller keeps the statistics.
+        """
+        # Nothing to write for failed lookups, so don't copy or rewrite the file at all
+        if "error" in metadata:
+            return "error"
+        if not any(metadata.get(field) for field in ("title", "artists", "album", "year", "composer", "genre", "language")):
+            logger.info(f"Skipping '{file_path.name}' - no metadata found")
+            return "skipped"
+        
+        if file_extension is None:
+            file_extension = file_path.suffix.lower()
+        
+        writer = self.writers.get(file_extension)
+        if writer is None:
+            logger.error(f"Unsupported file format: {file_extension or file_path.name}")
+            return "error"
+        return writer(file_path, metadata, existing_metadata)
 
     def process_files(self):
-        """Process all audio files in the input folder."""
-        audio_files = self.get_audio_files()
-        if not audio_files:
+        """Process all audio files in the input folder, starting while it is still being scanned."""
+        try:
+            asyncio.run(self._process_async(self.iter_audio_files()))
+        finally:
+            self.save_state()
+            self.cache.close()
+            self.io_pool.shutdown()
+            self.http_pool.shutdown()
+            self.session.close()
+        
+        if not self.stats["total_files"]:
             logger.warning("No audio files found to process.")
-            return
+        elif not self.stats["processed_files"]:
+            logger.info("All audio files have already been processed.")
+
+    async def _process_async(self, audio_files):
+        """
+        Process files from the `audio_files` iterator in batches of `batch_size`,
+        each looked up with a single Ollama request.
+        
+        A batch is started as soon as it has been filled, with at most twice
+        `concurrency` batches started and up to `concurrency` being looked up at
+        once. In interactive mode the changes are collected and reviewed one file
+        at a time once every lookup is done, so waiting on the user never holds up
+        the lookups.
+        """
+        loop = asyncio.get_running_loop()
+        sem = asyncio.Semaphore(self.concurrency)
+        pending = []
+        progress = tqdm(desc="Processing audio files")
+        done_count = 0
+        
+        def next_batch():
+            nonlocal done_count
+            batch = []
+            for file_path in audio_files:
+                # Skip files finished in an earlier run, unless forced
+                if not self.force and self.is_done(file_path):
+                    done_count += 1
+                    continue
+                batch.append(file_path)
+                if len(batch) == self.batch_size:
+                    break
+            return batch
+        
+        def file_done():
+            self.stats["processed_files"] += 1
+            progress.update(1)
             
-        logger.info(f"Starting to process {len(audio_files)} files...")
+            # Print batch status
+            processed = self.stats["processed_files"]
+            if processed % self.batch_size == 0 or processed == progress.total:
+                logger.info(f"Progress: {processed} files processed.")
+        
+        async def lookup(song_name, prompt):
+            # Roughly 4 characters per token is close enough for throttling
+            await self.rate_limiter.acquire(tokens=(len(_SYSTEM_MSG) + len(prompt)) // 4)
+            return await loop.run_in_executor(self.http_pool, self.get_metadata_from_ollama, song_name, prompt)
+        
+        async def lookup_batch(items):
+            songs = [(item["song_name"], item["existing_metadata"]) for item in items]
+            prompt = self.build_batch_prompt(songs)
+            await self.rate_limiter.acquire(tokens=(len(_SYSTEM_MSG) + len(prompt)) // 4)
+            return await loop.run_in_executor(self.http_pool, self.get_metadata_batch, songs, prompt)
         
-        for i, file_path in enumerate(tqdm(audio_files, desc="Processing audio files")):
+        async def update(file_path, file_extension, metadata, existing_metadata):
             try:
-                # Extract song name from filename
-                song_name = self.clean_filename(file_path.name)
-                file_type = file_path.suffix.upper()
-                logger.info(f"Processing ({i+1}/{len(audio_files)}) {file_type}: '{song_name}'")
-                
-                # Get existing metadata first
-                if file_path.suffix.lower() == ".mp3":
-                    existing_metadata = self.get_mp3_existing_metadata(file_path)
-                else:
-                    existing_metadata = self.get_opus_existing_metadata(file_path)
-                
-                # Get metadata from Ollama with context about existing metadata
-                metadata = self.get_metadata_from_ollama(song_name, existing_metadata)
-                
                 # Update audio file with metadata
-                success = self.update_audio_metadata(file_path, metadata)
+                status = await loop.run_in_executor(self.io_pool, self.update_audio_metadata, file_path, metadata, existing_metadata, file_extension)
                 
-                if success:
+                # Statistics are only ever updated here, on the event loop
+                if status == "success":
                     self.stats["success"] += 1
-                elif "error" in metadata:
-                    logger.error(f"Failed to update metadata: {metadata.get('error')}")
+                    self.mark_done(file_path)
+                elif status == "skipped":
+                    self.stats["skipped"] += 1
+                else:
+                    if "error" in metadata:
+                        logger.error(f"Failed to update metadata: {metadata.get('error')}")
                     self.stats["errors"] += 1
-                
-                # Update processed count
-                self.stats["processed_files"] += 1
-                
-                # Print batch status
-                if (i + 1) % self.batch_size == 0 or i == len(audio_files) - 1:
-                    logger.info(f"Progress: {i+1}/{len(audio_files)} files processed.")
-                    
-                # Delay to avoid overwhelming Ollama
-                if i < len(audio_files) - 1:
-                    time.sleep(self.rate_limit_delay)
-                    
             except Exception as e:
                 logger.error(f"Error processing file '{file_path}': {str(e)}")
                 self.stats["errors"] += 1
-                continue
+            finally:
+                file_done()
+        
+        async def process_batch(start, batch):
+            extensions = [file_path.suffix.lower() for file_path in batch]
+            
+            # Get existing metadata first, reading the whole batch on the I/O pool.
+            # A failed read is handled with the rest of that file below.
+            existing = await asyncio.gather(
+                *(loop.run_in_executor(self.io_pool, self.get_existing_metadata, file_path, file_extension)
+                  for file_path, file_extension in zip(batch, extensions)),
+                return_exceptions=True
+            )
+            
+            items = []
+            for offset, (file_path, file_extension, existing_metadata) in enumerate(zip(batch, extensions, existing)):
+                try:
+                    if isinstance(existing_metadata, Exception):
+                        raise existing_metadata
+                    
+                    # Extract song name from filename
+                    song_name = self.clean_filename(file_path.name)
+                    logger.debug(f"Processing ({start+offset+1}) {file_extension.upper()}: '{song_name}'")
+                    
+                    # Fully tagged files don't need a lookup, unless forced
+                    if not self.force and self._is_complete(existing_metadata):
+                        logger.info(f"Skipping fully-tagged '{file_path.name}'")
+                        self.stats["skipped"] += 1
+                        file_done()
+                        continue
+                    
+                    cache_key = self.cache.make_key(self.model, song_name, existing_metadata)
+                    metadata = self.cache.get(cache_key)
+                    if metadata is not None:
+                        logger.debug(f"Using cached metadata for '{song_name}'")
+                        self.stats["cache_hits"] += 1
+                    
+                    items.append({
+                        "file_path": file_path,
+                        "file_extension": file_extension,
+                        "song_name": song_name,
+                        "existing_metadata": existing_metadata,
+                        "cache_key": cache_key,
+                        "metadata": metadata
+                    })
+                except Exception as e:
+                    logger.error(f"Error processing file '{file_path}': {str(e)}")
+                    self.stats["errors"] += 1
+                    file_done()
+            
+            async with sem:
+                misses = [item for item in items if item["metadata"] is None]
+                if len(misses) > 1:
+                    results = await lookup_batch(misses)
+                    if results is not None:
+                        for item, metadata in zip(misses, results):
+                            item["metadata"] = metadata
+                
+                # Single misses, and batches whose response could not be matched up
+                for item in misses:
+                    if item["metadata"] is None:
+                        # Build the prompt with context about existing metadata
+                        prompt = self.build_prompt(item["song_name"], item["existing_metadata"])
+                        item["metadata"] = await lookup(item["song_name"], prompt)
+                    if "error" not in item["metadata"]:
+                        self.cache.put(item["cache_key"], item["song_name"], item["metadata"])
+            
+            if self.interactive_mode:
+                pending.extend(items)
+            else:
+                # Tag outside the semaphore so the next batch's lookup can start while this one is written
+                await asyncio.gather(*(update(item["file_path"], item["file_extension"], item["metadata"], item["existing_metadata"]) for item in items))
+            
+            self.save_state()
+        
+        tasks = []
+        queued = 0
+        # Only a few batches are started ahead of the lookups, so their tag reads don't
+        # queue up in front of the writes and the scan doesn't run far ahead
+        batch_slots = asyncio.Semaphore(2 * self.concurrency)
+        try:
+            # The scan blocks, so batches are pulled from it on a worker thread
+            while True:
+                await batch_slots.acquire()
+                batch = await loop.run_in_executor(None, next_batch)
+                if not batch:
+                    batch_slots.release()
+                    break
+                task = asyncio.create_task(process_batch(queued, batch))
+                task.add_done_callback(lambda _: batch_slots.release())
+                tasks.append(task)
+                queued += len(batch)
+            
+            if done_count:
+                logger.info(f"Skipping {done_count} files already processed in an earlier run (use --force to redo them)")
+                self.stats["skipped"] += done_count
+            if queued:
+                logger.info(f"Processing {queued} files...")
+            progress.total = queued
+            progress.refresh()
+            
+            await asyncio.gather(*tasks)
+            
+            # Review the collected changes
+            if pending:
+                logger.info(f"All lookups done, reviewing {len(pending)} files...")
+            for item in pending:
+                await update(item["file_path"], item["file_extension"], item["metadata"], item["existing_metadata"])
+                self.save_state()
+        finally:
+            progress.close()
     
     def print_summary(self):
         """Print a summary of the processing results."""
@@ -530,10 +1252,20 @@ Filename to analyze: "{song_name}"{existing_context}"""
         logger.info(f"Successful updates: {self.stats['success']}")
         logger.info(f"Skipped files: {self.stats['skipped']}")
         logger.info(f"Errors: {self.stats['errors']}")
+        logger.info(f"Cache hits: {self.stats['cache_hits']}")
         logger.info("="*50 + "\n")
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Update audio file metadata using Ollama.")
+    parser.add_argument("--force", action="store_true", default=FORCE,
+                        help="reprocess files that were already updated in an earlier run")
+    parser.add_argument("--workers", type=int, default=SCAN_WORKERS,
+                        help=f"threads used to scan the input folder (default: {SCAN_WORKERS})")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    
     try:
         print("Starting Audio Metadata Generator with Ollama")
         print(f"Input folder: {INPUT_FOLDER}")
@@ -541,7 +1273,7 @@ def main():
         print(f"Ollama URL: {OLLAMA_BASE_URL}")
         print(f"Ollama Model: {OLLAMA_MODEL}")
         
-        generator = AudioMetadataGenerator()
+        generator = AudioMetadataGenerator(force=args.force, scan_workers=args.workers)
         generator.process_files()
         generator.print_summary()
         
@@ -551,6 +1283,9 @@ def main():
         logger.error(f"Fatal error: {e}")
         print(f"Fatal error occurred: {e}")
         return 1
+    finally:
+        # Write out any log records still queued
+        log_listener.stop()
         
     return 0
 